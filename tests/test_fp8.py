@@ -0,0 +1,65 @@
+import pytest
+import torch
+from torch import nn
+
+from yet_another_retnet.fp8 import Float8Linear, fp8_available
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+requires_float8_dtype = pytest.mark.skipif(
+    not hasattr(torch, "float8_e4m3fn"), reason="requires PyTorch with FP8 dtypes"
+)
+
+
+@requires_float8_dtype
+@pytest.mark.parametrize("bias", [True, False])
+def test_float8_linear_quantization(bias: bool):
+    linear = nn.Linear(32, 48, bias=bias, device=DEVICE)
+    layer = Float8Linear(linear)
+    assert layer.weight_fp8.dtype == torch.float8_e4m3fn
+    assert layer.weight_scale.dtype == torch.float32
+    assert f"bias={bias}" in repr(layer)
+
+    # E4M3 has 3 mantissa bits, so the relative rounding error is at most 2 ** -4.
+    max_weight = linear.weight.abs().max().item()
+    torch.testing.assert_close(
+        layer.weight, linear.weight.detach(), rtol=2**-4, atol=max_weight * 2**-9
+    )
+
+
+@requires_float8_dtype
+@pytest.mark.parametrize("in_features, out_features", [(24, 32), (32, 40)])
+def test_float8_linear_invalid_shape(in_features: int, out_features: int):
+    linear = nn.Linear(in_features, out_features, device=DEVICE)
+    with pytest.raises(ValueError):
+        Float8Linear(linear)
+
+
+@requires_float8_dtype
+@pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float16, torch.float64])
+def test_float8_linear_cast(dtype: torch.dtype):
+    layer = Float8Linear(nn.Linear(32, 48, bias=True, device=DEVICE))
+    weight_fp8 = layer.weight_fp8.clone()
+
+    layer = layer.to(dtype)
+    # Module casts must not touch the FP8 weight or its (float32) scale.
+    assert layer.weight_fp8.dtype == torch.float8_e4m3fn
+    assert torch.equal(layer.weight_fp8.view(torch.uint8), weight_fp8.view(torch.uint8))
+    assert layer.weight_scale.dtype == torch.float32
+    assert layer.bias is not None and layer.bias.dtype == dtype
+    assert layer.dtype == dtype
+    assert layer.weight.dtype == dtype
+
+
+@pytest.mark.skipif(not fp8_available(), reason="requires a GPU with FP8 support")
+@torch.no_grad()
+@pytest.mark.parametrize("bias", [True, False])
+@pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float32])
+def test_float8_linear_forward(bias: bool, dtype: torch.dtype):
+    linear = nn.Linear(64, 32, bias=bias, device=DEVICE, dtype=dtype)
+    layer = Float8Linear(linear)
+    x = torch.randn(2, 8, 64, device=DEVICE, dtype=dtype)
+
+    y = layer(x)
+    assert y.dtype == dtype
+    torch.testing.assert_close(y, linear(x), rtol=1e-1, atol=1e-1)
@@ -0,0 +1,148 @@
+from typing import Optional
+
+import pytest
+import torch
+from torch import Tensor
+
+from yet_another_retnet.kernels import (
+    TRITON_AVAILABLE,
+    _input_precision,
+    _launch_config,
+    flash_retention_available,
+    retention_flash_fwd,
+    retention_step,
+)
+from yet_another_retnet.retention import retention_parallel, retention_recurrent
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+DTYPE = torch.float32
+# Set deterministic CUDA ops
+torch.backends.cudnn.deterministic = True
+torch.backends.cudnn.benchmark = False
+
+requires_triton = pytest.mark.skipif(
+    not (TRITON_AVAILABLE and torch.cuda.is_available()),
+    reason="fused kernels require Triton and a CUDA device",
+)
+requires_custom_op = pytest.mark.skipif(
+    not hasattr(torch.library, "custom_op"),
+    reason="custom ops require PyTorch >= 2.4",
+)
+
+
+def test_flash_retention_not_available_on_cpu():
+    x = torch.randn(2, 3, 16, 8)
+    assert not flash_retention_available(x, x, x)
+
+
+def test_input_precision():
+    allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+    try:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        assert _input_precision() == "tf32"
+        torch.backends.cuda.matmul.allow_tf32 = False
+        assert _input_precision() == "ieee"
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+
+
+@pytest.mark.parametrize("head_dim", [8, 64, 128, 256])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16])
+def test_launch_config(head_dim: int, dtype: torch.dtype):
+    block_m, block_n, num_warps, num_stages = _launch_config(head_dim, dtype)
+    # 'tl.dot' requires all block dimensions to be >= 16.
+    assert block_m >= 16 and block_n >= 16
+    assert num_warps > 0 and num_stages > 0
+
+    # Query tile, plus key/value tiles for each pipeline stage, must fit in the
+    # shared memory of consumer GPUs (~100 KB).
+    padded_dim = max(16, head_dim)
+    itemsize = torch.finfo(dtype).bits // 8
+    tile_elements = block_m * padded_dim + num_stages * 2 * block_n * padded_dim
+    assert tile_elements * itemsize <= 100 * 1024
+
+
+@requires_custom_op
+def test_fake_kernel_registrations():
+    # Fake implementations are used by 'torch.compile' to trace through the custom
+    # ops, without launching the kernels.  They run on any device.
+    from torch._subclasses.fake_tensor import FakeTensorMode
+
+    with FakeTensorMode():
+        query = torch.empty(2, 3, 16, 8)
+        value = torch.empty(2, 3, 16, 4)
+        out = retention_flash_fwd(query, query, value, torch.empty(3), 1.0)
+        assert out.shape == (2, 3, 16, 4)
+
+        query, value = query[:, :, 0], value[:, :, 0]
+        out, state = retention_step(query, query, value, None, torch.empty(3), 1.0)
+        assert out.shape == (2, 3, 4)
+        assert state.shape == (2, 3, 8, 4)
+
+
+@requires_triton
+@torch.no_grad()
+@pytest.mark.parametrize("batch_size", [2])
+@pytest.mark.parametrize("num_heads", [1, 3])
+@pytest.mark.parametrize("seq_length", [16, 100])
+# NOTE: All of the preconfigured RetNet models use head_dim = 256.
+@pytest.mark.parametrize("hidden_dim", [8, 64, 128, 256])
+@pytest.mark.parametrize(
+    "dtype, tolerance",
+    [(torch.float32, 1e-4), (torch.float16, 1e-2), (torch.bfloat16, 1e-1)],
+)
+def test_flash_retention_parallel(
+    batch_size: int,
+    num_heads: int,
+    seq_length: int,
+    hidden_dim: int,
+    dtype: torch.dtype,
+    tolerance: float,
+):
+    size = (batch_size, num_heads, seq_length, hidden_dim)
+    query = torch.randn(*size, device=DEVICE, dtype=dtype)
+    key = torch.randn(*size, device=DEVICE, dtype=dtype)
+    value = torch.randn(*size, device=DEVICE, dtype=dtype)
+    assert flash_retention_available(query, key, value)
+
+    y_flash, _ = retention_parallel(query, key, value)
+    # Requesting the weights forces the (unfused) PyTorch implementation.  Compute
+    # the reference in float32, since the kernel also accumulates in float32.
+    y_parallel, _ = retention_parallel(
+        query.float(), key.float(), value.float(), need_weights=True
+    )
+
+    torch.testing.assert_close(
+        y_flash.float(), y_parallel, rtol=tolerance, atol=tolerance
+    )
+
+
+@requires_triton
+@torch.no_grad()
+@pytest.mark.parametrize("batch_size", [2])
+@pytest.mark.parametrize("num_heads", [1, 3])
+@pytest.mark.parametrize("seq_length", [4])
+# NOTE: 128 is the largest supported head_dim (see 'MAX_RECURRENT_HEAD_DIM').
+@pytest.mark.parametrize("hidden_dim", [8, 64, 128])
+def test_fused_retention_recurrent(
+    batch_size: int,
+    num_heads: int,
+    seq_length: int,
+    hidden_dim: int,
+):
+    size = (batch_size, num_heads, seq_length, hidden_dim)
+    query = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    key = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    value = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+
+    fused_state: Optional[Tensor] = None
+    cpu_state: Optional[Tensor] = None
+    for i in range(seq_length):
+        q, k, v = query[:, :, i], key[:, :, i], value[:, :, i]
+        assert flash_retention_available(q, k, v)
+        y_fused, fused_state = retention_recurrent(q, k, v, fused_state)
+        # CPU tensors always use the PyTorch implementation.
+        y_cpu, cpu_state = retention_recurrent(q.cpu(), k.cpu(), v.cpu(), cpu_state)
+
+        torch.testing.assert_close(y_fused.cpu(), y_cpu, rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(fused_state.cpu(), cpu_state, rtol=1e-4, atol=1e-4)
@@ -1,14 +1,19 @@
+from math import log
 from typing import Optional
 
 import pytest
 import torch
 from torch import Tensor
 
+from yet_another_retnet.fp8 import fp8_available
 from yet_another_retnet.retention import (
     MultiScaleRetention,
+    _build_decay_bias,
     retention_chunkwise,
     retention_parallel,
     retention_recurrent,
+    retention_recurrent_batched,
+    retention_sdpa_approx,
 )
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -23,11 +28,87 @@ def test_retention_parallel_forward():
     pass
 
 
+@torch.no_grad()
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_retention_parallel_mixed_precision(dtype: torch.dtype):
+    size = (2, 4, 16, 8)
+    query = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    key = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    value = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+
+    y_full, _ = retention_parallel(query, key, value)
+    y_mixed, _ = retention_parallel(query, key, value, dtype=dtype)
+
+    # Output should be cast back to the input dtype.
+    assert y_mixed.dtype == DTYPE
+    tol = 1e-4 if dtype == torch.float32 else 2e-1
+    torch.testing.assert_close(y_full, y_mixed, rtol=tol, atol=tol)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("num_heads", [1, 4])
+@pytest.mark.parametrize("seq_length", [16])
+@pytest.mark.parametrize("hidden_dim", [8])
+def test_retention_sdpa_approx(num_heads: int, seq_length: int, hidden_dim: int):
+    size = (2, num_heads, seq_length, hidden_dim)
+    query = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    key = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    value = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+
+    y_sdpa = retention_sdpa_approx(query, key, value)
+
+    # Reference: softmax over the similarity scores, with the decay included as a
+    # log-space bias (and future keys masked out).
+    x = torch.linspace(log(1 / 32), log(1 / 512), num_heads, device=DEVICE)
+    log_gammas = torch.log(1 - x.exp()).to(DTYPE)
+    pos = torch.arange(seq_length, device=DEVICE)
+    distance = pos[:, None] - pos[None, :]
+    bias = torch.where(
+        distance >= 0, distance * log_gammas[:, None, None], float("-inf")
+    )
+    similarity = query @ key.transpose(-2, -1) / hidden_dim**0.5
+    y_expected = torch.softmax(similarity + bias, dim=-1) @ value
+    torch.testing.assert_close(y_sdpa, y_expected, rtol=1e-4, atol=1e-4)
+
+    # Non-default scales are folded into the query.
+    y_sdpa = retention_sdpa_approx(query, key, value, scale=2.0)
+    similarity = query @ key.transpose(-2, -1) / 2.0
+    y_expected = torch.softmax(similarity + bias, dim=-1) @ value
+    torch.testing.assert_close(y_sdpa, y_expected, rtol=1e-4, atol=1e-4)
+
+
+def test_decay_bias_float16():
+    # The fastest-decaying head underflows to zero in the (float16) decay mask after
+    # ~500 steps.  The bias is computed in log-space, so it should stay finite.
+    bias = _build_decay_bias(
+        num_heads=4, query_length=1024, key_length=1024, dtype=torch.float16
+    )
+    causal = torch.ones(1024, 1024, dtype=torch.bool).tril()
+    assert torch.isfinite(bias[..., causal]).all()
+    assert torch.isneginf(bias[..., ~causal]).all()
+
+    expected = _build_decay_bias(
+        num_heads=4, query_length=1024, key_length=1024, dtype=torch.float64
+    )
+    # NOTE: Loose tolerance, since the gammas themselves are rounded to float16
+    # (and 'log(gamma)' is sensitive to rounding, for gamma close to 1).
+    torch.testing.assert_close(
+        bias[..., causal].double(), expected[..., causal], rtol=5e-2, atol=1e-2
+    )
+
+
 def test_retention_recurrent_forward():
     # TODO
     pass
 
 
+def test_retention_recurrent_batched_empty_input():
+    size = (2, 2, 0, 8)
+    query = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    with pytest.raises(ValueError):
+        retention_recurrent_batched(query, query, query, prev_state=None)
+
+
 def test_retention_chunkwise_forward():
     # TODO
     pass
@@ -64,6 +145,13 @@ def test_equivalent_retention_formulations(
     torch.testing.assert_close(y_parallel, y_recurrent, rtol=1e-4, atol=1e-4)
     recurrent_state = prev_state
 
+    # Batched recurrent formulation
+    y_batched, batched_state = retention_recurrent_batched(
+        query, key, value, prev_state=None
+    )
+    torch.testing.assert_close(y_parallel, y_batched, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(recurrent_state, batched_state, rtol=1e-4, atol=1e-4)
+
     # Chunkwise formulation
     y_chunkwise = torch.zeros_like(y_parallel)
     prev_state = None
@@ -79,6 +167,79 @@ def test_equivalent_retention_formulations(
     torch.testing.assert_close(recurrent_state, prev_state, rtol=1e-4, atol=1e-4)
 
 
+@torch.no_grad()
+@pytest.mark.parametrize("chunk_size", [1, 4, 16])
+def test_equivalent_retention_formulations_custom_gammas(chunk_size: int):
+    size = (2, 2, 16, 8)
+    query = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    key = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    value = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    # Much faster decay than the defaults, so that any formulation which silently
+    # uses the default gammas would not match.
+    decay_gammas = torch.tensor([0.5, 0.9], device=DEVICE, dtype=DTYPE)
+
+    y_parallel, _ = retention_parallel(query, key, value, decay_gammas=decay_gammas)
+    y_default, _ = retention_parallel(query, key, value)
+    assert not torch.allclose(y_parallel, y_default, rtol=1e-4, atol=1e-4)
+
+    y_recurrent = torch.zeros_like(y_parallel)
+    recurrent_state: Optional[Tensor] = None
+    for i in range(size[2]):
+        q, k, v = query[:, :, i], key[:, :, i], value[:, :, i]
+        y_recurrent[:, :, i], recurrent_state = retention_recurrent(
+            q, k, v, recurrent_state, decay_gammas=decay_gammas
+        )
+    torch.testing.assert_close(y_parallel, y_recurrent, rtol=1e-4, atol=1e-4)
+
+    y_batched, batched_state = retention_recurrent_batched(
+        query, key, value, prev_state=None, decay_gammas=decay_gammas
+    )
+    torch.testing.assert_close(y_parallel, y_batched, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(recurrent_state, batched_state, rtol=1e-4, atol=1e-4)
+
+    y_chunkwise = torch.zeros_like(y_parallel)
+    chunk_state: Optional[Tensor] = None
+    for i in range(0, size[2], chunk_size):
+        q = query[:, :, i : i + chunk_size]
+        k = key[:, :, i : i + chunk_size]
+        v = value[:, :, i : i + chunk_size]
+        y_chunkwise[:, :, i : i + chunk_size], chunk_state = retention_chunkwise(
+            q, k, v, chunk_state, decay_gammas=decay_gammas
+        )
+    torch.testing.assert_close(y_parallel, y_chunkwise, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(recurrent_state, chunk_state, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("chunk_size", [4, 16])
+def test_retention_learnable_gammas(chunk_size: int):
+    size = (2, 2, 16, 8)
+    query = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    key = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    value = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    decay_gammas = torch.tensor(
+        [0.9, 0.8], device=DEVICE, dtype=DTYPE, requires_grad=True
+    )
+
+    y_parallel, _ = retention_parallel(query, key, value, decay_gammas=decay_gammas)
+    (grad_parallel,) = torch.autograd.grad(y_parallel.sum(), decay_gammas)
+    assert torch.isfinite(grad_parallel).all()
+
+    y_chunkwise = []
+    prev_state: Optional[Tensor] = None
+    for i in range(0, size[2], chunk_size):
+        q = query[:, :, i : i + chunk_size]
+        k = key[:, :, i : i + chunk_size]
+        v = value[:, :, i : i + chunk_size]
+        y, prev_state = retention_chunkwise(
+            q, k, v, prev_state, decay_gammas=decay_gammas
+        )
+        y_chunkwise.append(y)
+    (grad_chunkwise,) = torch.autograd.grad(
+        torch.cat(y_chunkwise, dim=2).sum(), decay_gammas
+    )
+    torch.testing.assert_close(grad_parallel, grad_chunkwise, rtol=1e-4, atol=1e-4)
+
+
 def test_multiscale_retention_forward_parallel():
     # TODO
     pass
@@ -89,6 +250,137 @@ def test_multiscale_retention_forward_recurrent():
     pass
 
 
+@torch.no_grad()
+@pytest.mark.parametrize("batch_size", [2])
+@pytest.mark.parametrize("num_heads", [1, 2])
+@pytest.mark.parametrize("seq_length", [8])
+@pytest.mark.parametrize("embed_dim", [16, 32])
+def test_multiscale_retention_packed_projections(
+    batch_size: int,
+    num_heads: int,
+    seq_length: int,
+    embed_dim: int,
+):
+    size = (batch_size, seq_length, embed_dim)
+    x = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    y = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    mhr = MultiScaleRetention(embed_dim, num_heads, device=DEVICE, dtype=DTYPE).eval()
+
+    # Identical inputs use the packed projections, while copies of the same input
+    # take the general (unpacked) path.  Both should give the same result.
+    y_self, _ = mhr.forward_parallel(x, x, x)
+    y_general, _ = mhr.forward_parallel(x, x.clone(), x.clone())
+    torch.testing.assert_close(y_self, y_general, rtol=1e-4, atol=1e-4)
+
+    y_kv, _ = mhr.forward_parallel(x, y, y)
+    y_general, _ = mhr.forward_parallel(x, y, y.clone())
+    torch.testing.assert_close(y_kv, y_general, rtol=1e-4, atol=1e-4)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("chunk_size", [1, 4])
+def test_multiscale_retention_updated_gammas(chunk_size: int):
+    seq_length = 8
+    x = torch.randn(2, seq_length, 16, device=DEVICE, dtype=DTYPE)
+    mhr = MultiScaleRetention(16, 2, device=DEVICE, dtype=DTYPE).eval()
+    y_default, _ = mhr.forward_parallel(x, x, x)
+    mhr.use_sdpa_approx = True
+    y_sdpa_default, _ = mhr.forward_parallel(x, x, x)
+    mhr.use_sdpa_approx = False
+
+    # In-place updates to the 'decay_gammas' buffer apply to *all* formulations.
+    default_gammas = mhr.decay_gammas.clone()
+    mhr.decay_gammas.fill_(0.5)
+    y_parallel, _ = mhr.forward_parallel(x, x, x)
+    assert not torch.allclose(y_parallel, y_default, rtol=1e-4, atol=1e-4)
+
+    y_recurrent = torch.zeros_like(y_parallel)
+    prev_state: Optional[Tensor] = None
+    for i in range(seq_length):
+        xi = x[:, i]
+        y_recurrent[:, i], prev_state = mhr.forward_recurrent(
+            xi, xi, xi, seq_idx=i, prev_state=prev_state
+        )
+    torch.testing.assert_close(y_parallel, y_recurrent, rtol=1e-4, atol=1e-4)
+
+    y_chunkwise = torch.zeros_like(y_parallel)
+    prev_state = None
+    for i in range(0, seq_length, chunk_size):
+        xc = x[:, i : i + chunk_size]
+        y_chunkwise[:, i : i + chunk_size], prev_state = mhr.forward_chunkwise(
+            xc, xc, xc, start_idx=i, prev_state=prev_state
+        )
+    torch.testing.assert_close(y_parallel, y_chunkwise, rtol=1e-4, atol=1e-4)
+
+    mhr.use_sdpa_approx = True
+    y_sdpa, _ = mhr.forward_parallel(x, x, x)
+    assert not torch.allclose(y_sdpa, y_sdpa_default, rtol=1e-4, atol=1e-4)
+
+    # Restoring the defaults goes back to the original outputs.
+    mhr.decay_gammas.copy_(default_gammas)
+    y_sdpa, _ = mhr.forward_parallel(x, x, x)
+    torch.testing.assert_close(y_sdpa, y_sdpa_default)
+    mhr.use_sdpa_approx = False
+    y_parallel, _ = mhr.forward_parallel(x, x, x)
+    torch.testing.assert_close(y_parallel, y_default)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("num_heads", [1, 2])
+@pytest.mark.parametrize("embed_dim", [16, 32])
+def test_multiscale_retention_load_legacy_state_dict(num_heads: int, embed_dim: int):
+    x = torch.randn(2, 8, embed_dim, device=DEVICE, dtype=DTYPE)
+    mhr = MultiScaleRetention(embed_dim, num_heads, device=DEVICE, dtype=DTYPE).eval()
+
+    # Older checkpoints stored separate q/k/v projections, with shape
+    # (num_heads, embed_dim, head_dim), instead of the packed 'qkv_proj' layer.
+    head_dim = embed_dim // num_heads
+    legacy = {k: v for k, v in mhr.state_dict().items() if k != "qkv_proj.weight"}
+    for name in ("q_proj", "k_proj", "v_proj"):
+        legacy[name] = torch.randn(
+            num_heads, embed_dim, head_dim, device=DEVICE, dtype=DTYPE
+        )
+    mhr.load_state_dict(dict(legacy), strict=True)
+
+    # Projections must match the original (einsum-based) formulation.
+    q, k, v = mhr._qkv_projection(x, x, x)
+    for name, projected in zip(("q_proj", "k_proj", "v_proj"), (q, k, v)):
+        expected = torch.einsum("bne,hed->bhnd", x, legacy[name])
+        torch.testing.assert_close(mhr._split_heads(projected), expected)
+
+    # Round trip: the converted module produces the same outputs after reloading
+    # its own (packed) state dict.
+    converted = MultiScaleRetention(embed_dim, num_heads, device=DEVICE, dtype=DTYPE)
+    converted.load_state_dict(mhr.state_dict())
+    y, _ = mhr.forward_parallel(x, x, x)
+    y_converted, _ = converted.eval().forward_parallel(x, x, x)
+    torch.testing.assert_close(y, y_converted)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("num_heads", [1, 2])
+@pytest.mark.parametrize("embed_dim", [16, 32])
+def test_multiscale_retention_sdpa_approx(num_heads: int, embed_dim: int):
+    x = torch.randn(2, 8, embed_dim, device=DEVICE, dtype=DTYPE)
+    mhr = MultiScaleRetention(
+        embed_dim, num_heads, use_sdpa_approx=True, device=DEVICE, dtype=DTYPE
+    ).eval()
+
+    y_sdpa, weights = mhr.forward_parallel(x, x, x)
+    assert y_sdpa.shape == x.shape
+    assert weights is None
+    assert torch.isfinite(y_sdpa).all()
+
+    # Requesting the weights falls back to exact retention, which does not apply
+    # a softmax, so the outputs should differ.
+    y_exact, weights = mhr.forward_parallel(x, x, x, need_weights=True)
+    assert weights is not None
+    mhr.use_sdpa_approx = False
+    y_retention, _ = mhr.forward_parallel(x, x, x)
+    torch.testing.assert_close(y_exact, y_retention)
+    assert not torch.allclose(y_sdpa, y_retention, rtol=1e-4, atol=1e-4)
+
+
 @torch.no_grad()
 @pytest.mark.parametrize("batch_size", [2])
 @pytest.mark.parametrize("num_heads", [1, 2])
@@ -141,3 +433,103 @@ def test_equivalent_multiscale_formulations(
 
     torch.testing.assert_close(y_parallel, y_chunkwise, rtol=1e-4, atol=1e-4)
     torch.testing.assert_close(recurrent_state, prev_state, rtol=1e-4, atol=1e-4)
+
+    y_batched = torch.zeros_like(y_parallel)
+    prev_state = None
+    for i in range(0, seq_length, chunk_size):
+        q = query[:, i : i + chunk_size]
+        k = key[:, i : i + chunk_size]
+        v = value[:, i : i + chunk_size]
+        y_batched[:, i : i + chunk_size], prev_state = mhr.forward_recurrent_batched(
+            q, k, v, start_idx=i, prev_state=prev_state
+        )
+
+    torch.testing.assert_close(y_parallel, y_batched, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(recurrent_state, prev_state, rtol=1e-4, atol=1e-4)
+
+
+def test_multiscale_retention_cast_drops_cuda_graph():
+    mhr = MultiScaleRetention(16, 2, use_cuda_graph=True, device=DEVICE, dtype=DTYPE)
+    # Stand-ins for a captured graph.  The real graph holds raw pointers to the
+    # parameters and buffers, which are reallocated by casting the module.
+    mhr._graph = object()  # type: ignore[assignment]
+    mhr._graph_key = ("captured",)
+    mhr._graph_inputs = {"query": torch.zeros(1, 16, device=DEVICE, dtype=DTYPE)}
+    mhr._graph_outputs = (torch.zeros(1, 16, device=DEVICE, dtype=DTYPE),)
+
+    mhr.float()
+    assert mhr._graph is None
+    assert mhr._graph_key is None
+    assert mhr._graph_inputs == {}
+    assert mhr._graph_outputs == ()
+    assert mhr.decay_gammas.dtype == torch.float32
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+@torch.no_grad()
+@pytest.mark.parametrize("batch_size", [2])
+@pytest.mark.parametrize("num_heads", [1, 2])
+@pytest.mark.parametrize("seq_length", [8])
+@pytest.mark.parametrize("embed_dim", [16, 32])
+def test_multiscale_retention_cuda_graph(
+    batch_size: int,
+    num_heads: int,
+    seq_length: int,
+    embed_dim: int,
+):
+    size = (batch_size, seq_length, embed_dim)
+    x = torch.randn(*size, device=DEVICE, dtype=DTYPE)
+    mhr = MultiScaleRetention(embed_dim, num_heads, device=DEVICE, dtype=DTYPE).eval()
+
+    y_eager = torch.zeros_like(x)
+    eager_state: Optional[Tensor] = None
+    for i in range(seq_length):
+        xi = x[:, i]
+        y_eager[:, i], eager_state = mhr.forward_recurrent(
+            xi, xi, xi, seq_idx=i, prev_state=eager_state
+        )
+
+    mhr.use_cuda_graph = True
+    y_graph = torch.zeros_like(x)
+    graph_state: Optional[Tensor] = None
+    for i in range(seq_length):
+        xi = x[:, i]
+        y_graph[:, i], graph_state = mhr.forward_recurrent(
+            xi, xi, xi, seq_idx=i, prev_state=graph_state
+        )
+    assert mhr._graph is not None
+
+    torch.testing.assert_close(y_eager, y_graph, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(eager_state, graph_state, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.skipif(fp8_available(), reason="requires a device without FP8 support")
+def test_multiscale_retention_fp8_unsupported():
+    mhr = MultiScaleRetention(32, 2, device=DEVICE, dtype=DTYPE)
+    with pytest.raises(RuntimeError):
+        mhr.to_fp8()
+
+
+@pytest.mark.skipif(not fp8_available(), reason="requires a GPU with FP8 support")
+@torch.no_grad()
+@pytest.mark.parametrize("batch_size", [2])
+@pytest.mark.parametrize("num_heads", [1, 2])
+@pytest.mark.parametrize("seq_length", [8])
+@pytest.mark.parametrize("embed_dim", [32, 64])
+def test_multiscale_retention_fp8(
+    batch_size: int,
+    num_heads: int,
+    seq_length: int,
+    embed_dim: int,
+):
+    size = (batch_size, seq_length, embed_dim)
+    x = torch.randn(*size, device=DEVICE, dtype=torch.bfloat16)
+    mhr = MultiScaleRetention(
+        embed_dim, num_heads, device=DEVICE, dtype=torch.bfloat16
+    ).eval()
+
+    y_bf16, _ = mhr.forward_parallel(x, x, x)
+    y_fp8, _ = mhr.to_fp8().forward_parallel(x, x, x)
+
+    # FP8 (E4M3) has only 3 mantissa bits, so use a loose tolerance.
+    torch.testing.assert_close(y_fp8, y_bf16, rtol=2e-1, atol=2e-1)
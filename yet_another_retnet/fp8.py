@@ -0,0 +1,118 @@
+"""FP8 (E4M3) linear layers for inference.
+
+FP8 tensor cores (Ada / Hopper GPUs, compute capability >= 8.9) have twice the
+throughput of BF16 tensor cores, and FP8 weights need half the memory bandwidth.
+Weights and activations are quantized with per-tensor scales, and matmuls are
+computed with 'torch._scaled_mm'.
+
+NOTE: This is intended for inference only.  Quantized layers have no trainable
+parameters, and their state dicts are not compatible with 'nn.Linear'.
+"""
+
+from typing import Optional, Tuple, Union
+
+import torch
+from torch import Tensor, nn
+
+# Largest finite value representable in float8_e4m3fn.
+E4M3_MAX = 448.0
+# Minimum compute capability with FP8 tensor cores (Ada Lovelace).
+MIN_FP8_CAPABILITY = (8, 9)
+
+
+def fp8_available(device: Optional[Union[torch.device, str]] = None) -> bool:
+    """Returns True if FP8 matmuls are supported on the given (CUDA) device."""
+    if not (hasattr(torch, "float8_e4m3fn") and hasattr(torch, "_scaled_mm")):
+        return False
+    if not torch.cuda.is_available():
+        return False
+    device = torch.device(device if device is not None else "cuda")
+    if device.type != "cuda":
+        return False
+    return torch.cuda.get_device_capability(device) >= MIN_FP8_CAPABILITY
+
+
+def _quantize(x: Tensor) -> Tuple[Tensor, Tensor]:
+    # Per-tensor scaling, so that the largest magnitude in 'x' maps to E4M3_MAX.
+    # Returns the quantized tensor, and the (float32) scale to de-quantize it.
+    amax = x.abs().amax().float().clamp(min=1e-12)
+    scale = amax / E4M3_MAX
+    x_fp8 = (x / scale).clamp(-E4M3_MAX, E4M3_MAX).to(torch.float8_e4m3fn)
+    return x_fp8, scale
+
+
+class Float8Linear(nn.Module):
+    """Drop-in (inference-only) replacement for 'nn.Linear', with FP8 weights.
+    Inputs are dynamically quantized to FP8 on each forward pass, and outputs are
+    returned in the layer's dtype (initially, that of the original weight).
+    """
+
+    def __init__(self, linear: nn.Linear):
+        super().__init__()
+        if linear.in_features % 16 != 0 or linear.out_features % 16 != 0:
+            raise ValueError(
+                "FP8 matmuls require in_features and out_features to be divisible "
+                f"by 16, but got ({linear.in_features}, {linear.out_features})"
+            )
+
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.dtype = linear.weight.dtype
+
+        weight_fp8, weight_scale = _quantize(linear.weight.detach())
+        self.weight_fp8: Tensor
+        self.weight_scale: Tensor
+        self.bias: Optional[Tensor]
+        self.register_buffer("weight_fp8", weight_fp8)
+        self.register_buffer("weight_scale", weight_scale)
+        bias = linear.bias.detach().clone() if linear.bias is not None else None
+        self.register_buffer("bias", bias)
+
+    def _apply(self, fn, *args, **kwargs):
+        # NOTE: Module casts (e.g. '.to(torch.bfloat16)', '.half()') apply to every
+        # floating-point buffer, including the FP8 weight and its scale.  Cast the
+        # layer as usual, then restore the FP8 weight (which is lossless, since any
+        # wider float type represents all E4M3 values exactly) and float32 scale.
+        # Outputs follow the new dtype, just like a regular 'nn.Linear'.
+        super()._apply(fn, *args, **kwargs)
+        self.weight_fp8 = self.weight_fp8.to(torch.float8_e4m3fn)
+        self.weight_scale = self.weight_scale.float()
+        self.dtype = fn(torch.empty(0, dtype=self.dtype)).dtype
+        return self
+
+    @property
+    def weight(self) -> Tensor:
+        # De-quantized weight.  Only for code paths that need the weight directly
+        # (e.g. slicing a packed projection) -- 'forward' uses the FP8 weight.
+        return self.weight_fp8.to(self.dtype) * self.weight_scale.to(self.dtype)
+
+    def forward(self, x: Tensor) -> Tensor:  # pragma: no cover
+        # NOTE: '_scaled_mm' only runs on FP8-capable GPUs, so this is excluded from
+        # CPU coverage.  See 'test_float8_linear_forward'.
+        batch_shape = x.shape[:-1]
+        x_fp8, x_scale = _quantize(x.reshape(-1, self.in_features))
+
+        # NOTE: 'torch._scaled_mm' does not support a bias with float32 outputs.
+        fused_bias = self.bias is not None and self.dtype != torch.float32
+        out = torch._scaled_mm(
+            x_fp8,
+            # Column-major layout, as required by '_scaled_mm'
+            self.weight_fp8.t(),
+            scale_a=x_scale,
+            scale_b=self.weight_scale,
+            bias=self.bias if fused_bias else None,
+            out_dtype=self.dtype,
+        )
+        # Older PyTorch versions also return the 'amax' of the output.
+        if isinstance(out, tuple):
+            out = out[0]
+        if self.bias is not None and not fused_bias:
+            out = out + self.bias
+
+        return out.reshape(*batch_shape, self.out_features)
+
+    def extra_repr(self) -> str:
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, "
+            f"bias={self.bias is not None}"
+        )
@@ -0,0 +1,422 @@
+"""Fused Triton kernels for retention.
+
+Triton is an optional dependency.  Everything in this module is guarded, so that
+'yet_another_retnet' can still be imported (and run on CPU) without it.  Use
+'flash_retention_available' to decide whether the fused kernels can be used for
+a given set of inputs -- if not, callers should fall back to the pure PyTorch
+implementations in 'retention.py'.
+"""
+
+from typing import Callable, Optional, Tuple
+
+import torch
+from torch import Tensor
+
+try:
+    import triton
+    import triton.language as tl
+
+    TRITON_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    TRITON_AVAILABLE = False
+
+# The kernels keep a full (BLOCK, head_dim) tile in registers, so very large
+# head dimensions would spill.  All of the preconfigured RetNet models (1.3B, 2.7B,
+# 6.7B) use head_dim = 256.
+MAX_HEAD_DIM = 256
+# The recurrent kernel keeps the entire (head_dim, head_dim) state in registers,
+# so it supports smaller head dimensions.
+MAX_RECURRENT_HEAD_DIM = 128
+SUPPORTED_DTYPES = (torch.float16, torch.bfloat16, torch.float32)
+
+
+def flash_retention_available(
+    *tensors: Tensor, max_head_dim: int = MAX_HEAD_DIM
+) -> bool:
+    """Returns True if the fused Triton kernels can be used for the given inputs.
+
+    NOTE: The kernels only implement the forward pass.  If any input requires
+    gradients, we fall back to the PyTorch implementation, which is differentiable.
+    """
+    if not TRITON_AVAILABLE:
+        return False
+    for x in tensors:
+        if not x.is_cuda or x.dtype not in SUPPORTED_DTYPES:
+            return False
+        if x.size(-1) > max_head_dim:
+            return False
+        if x.requires_grad and torch.is_grad_enabled():
+            return False
+    return True
+
+
+def _input_precision() -> str:
+    # Follow the same TF32 policy as 'torch.matmul', so that the fused kernels
+    # are numerically consistent with the PyTorch fallback.
+    return "tf32" if torch.backends.cuda.matmul.allow_tf32 else "ieee"
+
+
+# NOTE: Everything below that launches a kernel only runs on CUDA devices, and
+# Triton JIT-compiles the kernel bodies, so Python never executes them directly.
+# They are excluded from coverage, and tested separately on GPU machines (see
+# 'tests/test_kernels.py').
+if TRITON_AVAILABLE:  # pragma: no cover
+
+    @triton.jit
+    def _retention_flash_fwd_kernel(
+        Q,
+        K,
+        V,
+        LogGammas,
+        Out,
+        stride_qb,
+        stride_qh,
+        stride_qn,
+        stride_qd,
+        stride_kb,
+        stride_kh,
+        stride_kn,
+        stride_kd,
+        stride_vb,
+        stride_vh,
+        stride_vn,
+        stride_vd,
+        stride_ob,
+        stride_oh,
+        stride_on,
+        stride_od,
+        num_heads,
+        query_length,
+        key_length,
+        head_dim,
+        value_dim,
+        inv_scale,
+        BLOCK_M: tl.constexpr,
+        BLOCK_N: tl.constexpr,
+        HEAD_DIM: tl.constexpr,
+        VALUE_DIM: tl.constexpr,
+        INPUT_PRECISION: tl.constexpr,
+    ):
+        # Each program computes one (BLOCK_M, value_dim) tile of the output, for a
+        # single (batch, head) pair.  Key/value blocks are streamed through SRAM,
+        # so the full (n, s) similarity matrix is never materialized.
+        pid_m = tl.program_id(0)
+        pid_bh = tl.program_id(1)
+        b = pid_bh // num_heads
+        h = pid_bh % num_heads
+
+        offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+        offs_n = tl.arange(0, BLOCK_N)
+        offs_d = tl.arange(0, HEAD_DIM)
+        offs_v = tl.arange(0, VALUE_DIM)
+
+        q_ptrs = (
+            Q
+            + b * stride_qb
+            + h * stride_qh
+            + offs_m[:, None] * stride_qn
+            + offs_d[None, :] * stride_qd
+        )
+        q_mask = (offs_m[:, None] < query_length) & (offs_d[None, :] < head_dim)
+        q = tl.load(q_ptrs, mask=q_mask, other=0.0)
+        log_gamma = tl.load(LogGammas + h).to(tl.float32)
+
+        # NOTE: Retention has no softmax, so there is no need for the running max /
+        # rescaling from FlashAttention.  A plain accumulator is sufficient.
+        acc = tl.zeros((BLOCK_M, VALUE_DIM), dtype=tl.float32)
+        # Causal: future keys (j > i) are masked out, so we can stop iterating at
+        # the diagonal block.
+        hi = tl.minimum((pid_m + 1) * BLOCK_M, key_length)
+        for start_n in range(0, hi, BLOCK_N):
+            cols = start_n + offs_n
+            k_ptrs = (
+                K
+                + b * stride_kb
+                + h * stride_kh
+                + cols[:, None] * stride_kn
+                + offs_d[None, :] * stride_kd
+            )
+            k_mask = (cols[:, None] < key_length) & (offs_d[None, :] < head_dim)
+            k = tl.load(k_ptrs, mask=k_mask, other=0.0)
+            v_ptrs = (
+                V
+                + b * stride_vb
+                + h * stride_vh
+                + cols[:, None] * stride_vn
+                + offs_v[None, :] * stride_vd
+            )
+            v_mask = (cols[:, None] < key_length) & (offs_v[None, :] < value_dim)
+            v = tl.load(v_ptrs, mask=v_mask, other=0.0)
+
+            similarity = tl.dot(q, tl.trans(k), input_precision=INPUT_PRECISION)
+            # Decay mask (gamma ** (i - j)), computed in registers for this block.
+            distance = (offs_m[:, None] - cols[None, :]).to(tl.float32)
+            decay = tl.where(distance >= 0, tl.exp(log_gamma * distance), 0.0)
+            similarity = similarity * decay * inv_scale
+            acc += tl.dot(similarity.to(v.dtype), v, input_precision=INPUT_PRECISION)
+
+        out_ptrs = (
+            Out
+            + b * stride_ob
+            + h * stride_oh
+            + offs_m[:, None] * stride_on
+            + offs_v[None, :] * stride_od
+        )
+        out_mask = (offs_m[:, None] < query_length) & (offs_v[None, :] < value_dim)
+        tl.store(out_ptrs, acc.to(Out.dtype.element_ty), mask=out_mask)
+
+    @triton.jit
+    def _retention_step_kernel(
+        Q,
+        K,
+        V,
+        PrevState,
+        Gammas,
+        Out,
+        State,
+        stride_qb,
+        stride_qh,
+        stride_qd,
+        stride_kb,
+        stride_kh,
+        stride_kd,
+        stride_vb,
+        stride_vh,
+        stride_vd,
+        stride_pb,
+        stride_ph,
+        stride_pd,
+        stride_pm,
+        stride_ob,
+        stride_oh,
+        stride_om,
+        stride_sb,
+        stride_sh,
+        stride_sd,
+        stride_sm,
+        num_heads,
+        head_dim,
+        value_dim,
+        inv_scale,
+        HEAD_DIM: tl.constexpr,
+        VALUE_DIM: tl.constexpr,
+        HAS_PREV_STATE: tl.constexpr,
+    ):
+        # Each program handles a single (batch, head) pair, and performs the entire
+        # recurrent update in one pass: outer product, state decay, and contraction
+        # with the query.
+        pid = tl.program_id(0)
+        b = pid // num_heads
+        h = pid % num_heads
+
+        offs_d = tl.arange(0, HEAD_DIM)
+        offs_m = tl.arange(0, VALUE_DIM)
+        mask_d = offs_d < head_dim
+        mask_m = offs_m < value_dim
+        state_mask = mask_d[:, None] & mask_m[None, :]
+
+        q_ptrs = Q + b * stride_qb + h * stride_qh + offs_d * stride_qd
+        q = tl.load(q_ptrs, mask=mask_d, other=0.0).to(tl.float32)
+        k_ptrs = K + b * stride_kb + h * stride_kh + offs_d * stride_kd
+        k = tl.load(k_ptrs, mask=mask_d, other=0.0).to(tl.float32)
+        v_ptrs = V + b * stride_vb + h * stride_vh + offs_m * stride_vd
+        v = tl.load(v_ptrs, mask=mask_m, other=0.0).to(tl.float32)
+
+        state = (k * inv_scale)[:, None] * v[None, :]
+        if HAS_PREV_STATE:
+            gamma = tl.load(Gammas + h).to(tl.float32)
+            prev_ptrs = (
+                PrevState
+                + b * stride_pb
+                + h * stride_ph
+                + offs_d[:, None] * stride_pd
+                + offs_m[None, :] * stride_pm
+            )
+            prev_state = tl.load(prev_ptrs, mask=state_mask, other=0.0)
+            state += gamma * prev_state.to(tl.float32)
+        out = tl.sum(q[:, None] * state, axis=0)
+
+        out_ptrs = Out + b * stride_ob + h * stride_oh + offs_m * stride_om
+        tl.store(out_ptrs, out.to(Out.dtype.element_ty), mask=mask_m)
+        state_ptrs = (
+            State
+            + b * stride_sb
+            + h * stride_sh
+            + offs_d[:, None] * stride_sd
+            + offs_m[None, :] * stride_sm
+        )
+        tl.store(state_ptrs, state.to(State.dtype.element_ty), mask=state_mask)
+
+
+def _launch_config(head_dim: int, dtype: torch.dtype) -> Tuple[int, int, int, int]:
+    # Returns (BLOCK_M, BLOCK_N, num_warps, num_stages).  Each program holds one
+    # (BLOCK_M, head_dim) query tile, plus (BLOCK_N, head_dim) key/value tiles for
+    # every pipeline stage, in shared memory.  Shrink the tiles and the number of
+    # stages as the head dimension (and element size) grows, so that head_dim = 256
+    # in float32 still fits in ~64 KB of shared memory.
+    # NOTE: 'tl.dot' requires all block dimensions to be >= 16.
+    wide = dtype == torch.float32
+    if head_dim <= 64:
+        return 64, 64, 4, 2 if wide else 3
+    if head_dim <= 128:
+        return (32, 32, 4, 2) if wide else (64, 32, 4, 2)
+    return (32, 16, 4, 1) if wide else (64, 32, 8, 1)
+
+
+def _retention_flash_fwd(
+    query: Tensor,
+    key: Tensor,
+    value: Tensor,
+    log_gammas: Tensor,
+    scale: float,
+) -> Tensor:  # pragma: no cover
+    # einstein notation:
+    # - b: batch_size
+    # - h: num_heads
+    # - n / s: seq_length
+    # - d: head_dim
+    #
+    # Input shapes: query (b, h, n, d), key (b, h, s, d), value (b, h, s, d)
+    batch_size, num_heads, query_length, head_dim = query.shape
+    key_length, value_dim = key.size(2), value.size(-1)
+    out = torch.empty(
+        batch_size,
+        num_heads,
+        query_length,
+        value_dim,
+        device=query.device,
+        dtype=query.dtype,
+    )
+
+    block_m, block_n, num_warps, num_stages = _launch_config(head_dim, query.dtype)
+    grid = (triton.cdiv(query_length, block_m), batch_size * num_heads)
+    _retention_flash_fwd_kernel[grid](
+        query,
+        key,
+        value,
+        log_gammas,
+        out,
+        *query.stride(),
+        *key.stride(),
+        *value.stride(),
+        *out.stride(),
+        num_heads,
+        query_length,
+        key_length,
+        head_dim,
+        value_dim,
+        1 / scale,
+        BLOCK_M=block_m,
+        BLOCK_N=block_n,
+        HEAD_DIM=max(16, triton.next_power_of_2(head_dim)),
+        VALUE_DIM=max(16, triton.next_power_of_2(value_dim)),
+        INPUT_PRECISION=_input_precision(),
+        num_warps=num_warps,
+        num_stages=num_stages,
+    )
+    return out
+
+
+def _retention_step(
+    query: Tensor,
+    key: Tensor,
+    value: Tensor,
+    prev_state: Optional[Tensor],
+    decay_gammas: Tensor,
+    scale: float,
+) -> Tuple[Tensor, Tensor]:  # pragma: no cover
+    # einstein notation:
+    # - b: batch_size
+    # - h: num_heads
+    # - d / m: head_dim
+    #
+    # Input shapes: query (b, h, d), key (b, h, d), value (b, h, m),
+    # prev_state (b, h, d, m)
+    batch_size, num_heads, head_dim = query.shape
+    value_dim = value.size(-1)
+    out = torch.empty_like(value)
+    state = torch.empty(
+        batch_size,
+        num_heads,
+        head_dim,
+        value_dim,
+        device=query.device,
+        dtype=query.dtype,
+    )
+    # NOTE: If there is no previous state, the kernel never reads 'PrevState', so
+    # any tensor (with the right number of strides) can be passed in its place.
+    has_prev_state = prev_state is not None
+    _prev_state = prev_state if prev_state is not None else state
+
+    head_block = triton.next_power_of_2(head_dim)
+    value_block = triton.next_power_of_2(value_dim)
+    _retention_step_kernel[(batch_size * num_heads,)](
+        query,
+        key,
+        value,
+        _prev_state,
+        decay_gammas,
+        out,
+        state,
+        *query.stride(),
+        *key.stride(),
+        *value.stride(),
+        *_prev_state.stride(),
+        *out.stride(),
+        *state.stride(),
+        num_heads,
+        head_dim,
+        value_dim,
+        1 / scale,
+        HEAD_DIM=head_block,
+        VALUE_DIM=value_block,
+        HAS_PREV_STATE=has_prev_state,
+        # The full (head_dim, value_dim) state lives in registers.  Spread large
+        # states over more warps, to limit register pressure (and spills).
+        num_warps=8 if head_block * value_block >= 128 * 128 else 4,
+    )
+    return out, state
+
+
+retention_flash_fwd: Callable[..., Tensor]
+retention_step: Callable[..., Tuple[Tensor, Tensor]]
+
+if hasattr(torch.library, "custom_op"):
+    # Register as custom ops (PyTorch >= 2.4), so that 'torch.compile' treats the
+    # kernels as opaque nodes instead of trying to trace through them.
+    _retention_flash_fwd_op = torch.library.custom_op(
+        "yet_another_retnet::retention_flash_fwd", mutates_args=()
+    )(_retention_flash_fwd)
+
+    @_retention_flash_fwd_op.register_fake
+    def _(
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        log_gammas: Tensor,
+        scale: float,
+    ) -> Tensor:
+        return query.new_empty(*query.shape[:-1], value.size(-1))
+
+    _retention_step_op = torch.library.custom_op(
+        "yet_another_retnet::retention_step", mutates_args=()
+    )(_retention_step)
+
+    @_retention_step_op.register_fake
+    def _(
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        prev_state: Optional[Tensor],
+        decay_gammas: Tensor,
+        scale: float,
+    ) -> Tuple[Tensor, Tensor]:
+        state = query.new_empty(*query.shape, value.size(-1))
+        return torch.empty_like(value), state
+
+    retention_flash_fwd = _retention_flash_fwd_op
+    retention_step = _retention_step_op
+
+else:  # pragma: no cover
+    retention_flash_fwd = _retention_flash_fwd
+    retention_step = _retention_step
@@ -1,12 +1,20 @@
 from functools import lru_cache
 from math import log
-from typing import Callable, Literal, Optional, Tuple, Union
+from typing import Callable, Dict, Hashable, Literal, Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
-from einops import einsum, rearrange, repeat
+from einops import rearrange, repeat
 from torch import Tensor, nn
 
+from yet_another_retnet.fp8 import MIN_FP8_CAPABILITY, Float8Linear, fp8_available
+from yet_another_retnet.kernels import (
+    MAX_RECURRENT_HEAD_DIM,
+    flash_retention_available,
+    retention_flash_fwd,
+    retention_step,
+)
+
 DEFAULT_DEVICE = torch.device("cpu")
 ActivationString = Literal["swish", "gelu", "relu"]
 
@@ -26,7 +34,10 @@ def _get_activation_fn(activation: str) -> Callable[[Tensor], Tensor]:
         )
 
 
-@lru_cache(maxsize=1)
+# NOTE: Decay gammas are tiny (one value per head), so we cache a handful of them.
+# The flash kernel requests float32 values, while the PyTorch implementations use
+# the input dtype, so a cache of size 1 would thrash between the two.
+@lru_cache(maxsize=8)
 def _build_decay_gammas(
     num_heads: int,
     device: Optional[Union[torch.device, str]] = None,
@@ -45,7 +56,25 @@ def _build_decay_gammas(
     return 1 - x.exp_()
 
 
-@lru_cache(maxsize=1)
+@lru_cache(maxsize=8)
+def _build_log_decay_gammas(
+    num_heads: int,
+    device: Optional[Union[torch.device, str]] = None,
+    dtype: Optional[torch.dtype] = None,
+) -> Tensor:
+    """Natural logarithm of the decay gammas (see '_build_decay_gammas').  Decay
+    values are raised to integer powers in several places, which we compute as
+    'exp(log_gamma * distance)' -- a cheap pointwise op, compared to a generic 'pow'.
+    """
+    decay_gammas = _build_decay_gammas(num_heads=num_heads, device=device, dtype=dtype)
+    return decay_gammas.log()
+
+
+# NOTE: Decay masks can be large (num_heads * query_length * key_length), so keep
+# only a few of them.  That is enough for typical usage (e.g. a fixed training
+# sequence length, or chunkwise retention with a shorter final chunk), without
+# holding onto a lot of unused device memory.
+@lru_cache(maxsize=4)
 def _build_decay_mask(
     num_heads: int,
     query_length: int,
@@ -58,24 +87,78 @@ def _build_decay_mask(
     and applied to the similarity matrix at once, rather than being applied to
     each element in the recurrent formulation.
 
+    The mask is cached across calls (keyed by shape, device, and dtype), and is
+    returned with shape (1, num_heads, query_length, key_length), so that it can be
+    multiplied directly with the similarity matrix.  Do not modify it in-place!
+
     See: https://arxiv.org/pdf/2307.08621v3.pdf, Equation 5
     """
-    decay_gammas = _build_decay_gammas(num_heads=num_heads, device=device, dtype=dtype)
+    log_decay_gammas = _build_log_decay_gammas(
+        num_heads=num_heads, device=device, dtype=dtype
+    )
+    return _decay_mask_from_log_gammas(log_decay_gammas, query_length, key_length)
+
 
-    query_pos = torch.arange(query_length, device=device, dtype=dtype).unsqueeze_(-1)
-    key_pos = torch.arange(key_length, device=device, dtype=dtype).unsqueeze_(0)
-    distance = torch.abs(query_pos - key_pos)
+def _decay_mask_from_log_gammas(
+    log_decay_gammas: Tensor, query_length: int, key_length: int
+) -> Tensor:
+    """Uncached version of '_build_decay_mask', for arbitrary (e.g. user-provided)
+    decay gammas.  Returns a mask with shape (1, num_heads, query_length, key_length).
+    """
+    device = log_decay_gammas.device
+    query_pos = torch.arange(query_length, device=device).unsqueeze_(-1)
+    key_pos = torch.arange(key_length, device=device).unsqueeze_(0)
+    # NOTE: Clamp the distance for *future* keys to zero, rather than computing
+    # 'gamma ** inf'.  This avoids the special-case handling of 'inf' in 'pow', and
+    # any 'inf * 0 = nan' corner cases.  Future keys are masked out below.
+    distance = (query_pos - key_pos).clamp_(min=0).to(log_decay_gammas.dtype)
 
-    distance = rearrange(distance, "n s -> () n s")
-    decay_gammas = rearrange(decay_gammas, "h -> h () ()")
     # NOTE: Keep only the lower-triangular elements (including the diagonal), so that
-    # *future* keys cannot affect the current query. The .tril() method is not yet
-    # implemented for bfloat16 dtypes, so we use .masked_fill_() instead,
-    # which is slightly slower.
+    # *future* keys cannot affect the current query. The .tril() method is not
+    # implemented for bfloat16 dtypes in older PyTorch versions, so we use
+    # .masked_fill() instead.
     # Thanks to @Doraemonzzz for catching this bug!
-    decay_mask = decay_gammas**distance
-    future_mask = torch.ones_like(decay_mask, dtype=torch.bool).triu_(diagonal=1)
-    return decay_mask.masked_fill_(future_mask, 0)
+    #
+    # NOTE: Out-of-place, since autograd saves the output of 'exp' for the backward
+    # pass.  Modifying it in-place would break learnable decay gammas.
+    decay_mask = torch.exp(log_decay_gammas[:, None, None] * distance)
+    return decay_mask.masked_fill(query_pos < key_pos, 0).unsqueeze(0)
+
+
+@lru_cache(maxsize=4)
+def _build_decay_bias(
+    num_heads: int,
+    query_length: int,
+    key_length: int,
+    device: Optional[Union[torch.device, str]] = None,
+    dtype: Optional[torch.dtype] = None,
+) -> Tensor:
+    """Additive (log-space) version of the decay mask, i.e. 'log(gamma ** (i - j))',
+    for use as an attention bias.  Future keys have a bias of -inf.
+    """
+    log_decay_gammas = _build_log_decay_gammas(
+        num_heads=num_heads, device=device, dtype=dtype
+    )
+    return _decay_bias_from_log_gammas(log_decay_gammas, query_length, key_length)
+
+
+def _decay_bias_from_log_gammas(
+    log_decay_gammas: Tensor, query_length: int, key_length: int
+) -> Tensor:
+    """Uncached version of '_build_decay_bias'.  Returns a bias with shape
+    (1, num_heads, query_length, key_length).
+
+    NOTE: Compute 'log_gamma * (i - j)' directly, rather than the log of the decay
+    mask.  That avoids a round trip through 'exp', and the mask underflows to zero
+    for distant keys (e.g. after ~500 steps in float16, for the fastest-decaying
+    head), which would incorrectly turn their bias into -inf.
+    """
+    device = log_decay_gammas.device
+    query_pos = torch.arange(query_length, device=device).unsqueeze_(-1)
+    key_pos = torch.arange(key_length, device=device).unsqueeze_(0)
+    distance = (query_pos - key_pos).clamp_(min=0).to(log_decay_gammas.dtype)
+    decay_bias = log_decay_gammas[:, None, None] * distance
+    return decay_bias.masked_fill(query_pos < key_pos, float("-inf")).unsqueeze(0)
 
 
 def _build_position_thetas(
@@ -119,33 +202,87 @@ def _theta_shift(x: Tensor, sin: Tensor, cos: Tensor) -> Tensor:
     return (x * cos) + (_multiply_by_i(x) * sin)
 
 
+@torch.jit.script
+def _swish_gate(x: Tensor, gate: Tensor) -> Tensor:
+    # Scripted, so that the JIT fuser can combine 'silu' and the multiply into a
+    # single elementwise kernel, without materializing 'silu(gate)'.
+    return x * F.silu(gate)
+
+
 def retention_parallel(
     query: Tensor,
     key: Tensor,
     value: Tensor,
     scale: Optional[float] = None,
     need_weights: bool = False,
+    dtype: Optional[torch.dtype] = None,
+    decay_gammas: Optional[Tensor] = None,
 ) -> Tuple[Tensor, Optional[Tensor]]:
-    decay_mask = _build_decay_mask(
-        num_heads=query.shape[1],
-        query_length=query.shape[2],
-        key_length=key.shape[2],
-        device=query.device,
-        dtype=query.dtype,
+    # NOTE: If 'dtype' is given (e.g. torch.bfloat16), the two large matmuls are
+    # computed in that dtype, so they can run on tensor cores.  The decay mask is
+    # still applied in the original (input) dtype, and the output is cast back to
+    # it.  Callers should keep everything downstream (e.g. group norm) in full
+    # precision as well, since normalization is sensitive to rounding errors.
+    out_dtype = query.dtype
+    if dtype is not None:
+        query, key, value = query.to(dtype), key.to(dtype), value.to(dtype)
+    if scale is None:
+        scale = key.size(-1) ** 0.5
+
+    # NOTE: The fused kernel has no backward pass, so it cannot be used with
+    # learnable decay gammas either.
+    learnable_gammas = (
+        decay_gammas is not None
+        and decay_gammas.requires_grad
+        and torch.is_grad_enabled()
     )
+    if (
+        not need_weights
+        and not learnable_gammas
+        and flash_retention_available(query, key, value)
+    ):
+        # Fused kernel, which never materializes the full similarity matrix.
+        # NOTE: Decay coefficients are computed in float32 inside the kernel, so
+        # we also build their logarithms in float32 (regardless of input dtype).
+        if decay_gammas is None:
+            log_decay_gammas = _build_log_decay_gammas(
+                num_heads=query.shape[1], device=query.device, dtype=torch.float32
+            )
+        else:
+            log_decay_gammas = decay_gammas.float().log()
+        retention = retention_flash_fwd(query, key, value, log_decay_gammas, scale)
+        return retention.to(out_dtype), None
+
+    if decay_gammas is None:
+        decay_mask = _build_decay_mask(
+            num_heads=query.shape[1],
+            query_length=query.shape[2],
+            key_length=key.shape[2],
+            device=query.device,
+            dtype=out_dtype,
+        )
+    else:
+        decay_mask = _decay_mask_from_log_gammas(
+            decay_gammas.to(out_dtype).log(), query.shape[2], key.shape[2]
+        )
 
     # einstein notation:
     # - b: batch_size
     # - h: num_heads
     # - n / s: seq_length
     # - d: hidden_dim
-    if scale is None:
-        scale = key.size(-1) ** 0.5
     key = key / scale
 
-    similarity = einsum(query, key, "b h n d, b h s d -> b h n s")
-    similarity = similarity * rearrange(decay_mask, "h n s -> () h n s")
-    retention = einsum(similarity, value, "b h n s, b h s d -> b h n d")
+    # NOTE: Use 'torch.matmul' rather than 'einsum', which dispatches straight to
+    # a batched GEMM.  The transpose on its own is free (a strided view, which BLAS
+    # handles with its transpose flag).  But 'matmul' folds (b, h) into a single
+    # batch dimension, and keys from 'MultiScaleRetention' are views in (b, s, h, d)
+    # memory order (see '_split_heads'), so that fold copies the key.  Producing the
+    # key in a pre-transposed (b, h, d, s) layout upstream would not help: it needs
+    # the same copy out of (b, s, h, d) memory, just in a different place.
+    similarity = torch.matmul(query, key.transpose(-2, -1)).to(out_dtype)
+    similarity = similarity * decay_mask
+    retention = torch.matmul(similarity.to(value.dtype), value).to(out_dtype)
 
     if need_weights:
         return retention, similarity
@@ -153,16 +290,60 @@ def retention_parallel(
         return retention, None
 
 
+def retention_sdpa_approx(
+    query: Tensor,
+    key: Tensor,
+    value: Tensor,
+    scale: Optional[float] = None,
+    decay_gammas: Optional[Tensor] = None,
+) -> Tensor:
+    """Approximate parallel retention with 'F.scaled_dot_product_attention', where
+    the decay mask is applied as an additive log-space bias.  This dispatches to
+    the fused attention backends in PyTorch (Flash / memory-efficient / cuDNN).
+
+    NOTE: This is *not* equivalent to retention!  SDPA applies a softmax over the
+    (decayed) similarity scores, which retention does not.  It is only useful when
+    that difference can be tolerated (e.g. models fine-tuned in this mode), and
+    there is no matching recurrent or chunkwise formulation.
+    """
+    if not hasattr(F, "scaled_dot_product_attention"):
+        raise RuntimeError(
+            "retention_sdpa_approx requires 'F.scaled_dot_product_attention' "
+            "(PyTorch >= 2.0)"
+        )
+    if decay_gammas is None:
+        decay_bias = _build_decay_bias(
+            num_heads=query.shape[1],
+            query_length=query.shape[2],
+            key_length=key.shape[2],
+            device=query.device,
+            dtype=query.dtype,
+        )
+    else:
+        decay_bias = _decay_bias_from_log_gammas(
+            decay_gammas.to(query.dtype).log(), query.shape[2], key.shape[2]
+        )
+    # NOTE: The 'scale' argument of SDPA only exists in PyTorch >= 2.1.  SDPA always
+    # scales by 1 / sqrt(head_dim), so fold any other scale into the query instead.
+    if scale is not None and scale != query.size(-1) ** 0.5:
+        query = query * (query.size(-1) ** 0.5 / scale)
+    # NOTE: The causal mask is already included in 'decay_bias' (as -inf), and
+    # SDPA does not allow 'is_causal=True' together with an explicit mask.
+    return F.scaled_dot_product_attention(query, key, value, attn_mask=decay_bias)
+
+
 def retention_recurrent(
     query: Tensor,
     key: Tensor,
     value: Tensor,
     prev_state: Optional[Tensor],
     scale: Optional[float] = None,
+    decay_gammas: Optional[Tensor] = None,
 ) -> Tuple[Tensor, Tensor]:
-    decay_gammas = _build_decay_gammas(
-        num_heads=query.shape[1], device=query.device, dtype=query.dtype
-    )
+    if decay_gammas is None:
+        decay_gammas = _build_decay_gammas(
+            num_heads=query.shape[1], device=query.device, dtype=query.dtype
+        )
 
     # einstein notation:
     # - b: batch_size
@@ -170,34 +351,64 @@ def retention_recurrent(
     # - d: hidden_dim
     if scale is None:
         scale = key.size(-1) ** 0.5
-    key = key / scale
 
-    state = einsum(key, value, "b h d, b h m -> b h d m")
+    inputs = [query, key, value]
     if prev_state is not None:
-        state = state + prev_state * rearrange(decay_gammas, "h -> () h () ()")
-    retention = einsum(query, state, "b h d, b h d m -> b h m")
+        inputs.append(prev_state)
+    if flash_retention_available(*inputs, max_head_dim=MAX_RECURRENT_HEAD_DIM):
+        # Fused kernel, which performs the entire update in a single launch.
+        return retention_step(query, key, value, prev_state, decay_gammas, scale)
+
+    key = key / scale
+    # NOTE: These tensors are tiny (one token at a time), so 'einsum' overhead is
+    # significant.  Use an explicit outer product and batched GEMV instead.
+    if prev_state is None:
+        state = key.unsqueeze(-1) * value.unsqueeze(-2)
+    else:
+        # Decay the previous state, then accumulate the outer product in-place.
+        # Two kernels, rather than three (outer product, decay, and sum).
+        state = prev_state * decay_gammas[:, None, None]
+        state.addcmul_(key.unsqueeze(-1), value.unsqueeze(-2))
+    retention = torch.matmul(query.unsqueeze(-2), state).squeeze(-2)
 
     return retention, state
 
 
-def retention_chunkwise(
+def retention_recurrent_batched(
     query: Tensor,
     key: Tensor,
     value: Tensor,
     prev_state: Optional[Tensor],
     scale: Optional[float] = None,
+    decay_gammas: Optional[Tensor] = None,
 ) -> Tuple[Tensor, Tensor]:
-    decay_gammas = _build_decay_gammas(
-        num_heads=query.shape[1], device=query.device, dtype=query.dtype
-    )
-    decay_mask = _build_decay_mask(
-        num_heads=query.shape[1],
-        query_length=query.shape[2],
-        key_length=key.shape[2],
-        device=query.device,
-        dtype=query.dtype,
+    """Recurrent retention over multiple time steps in a single call.  Equivalent
+    to calling 'retention_recurrent' once per time step.  Useful for e.g. warming up
+    the state (prefill) before autoregressive decoding.
+
+    NOTE: This is chunkwise retention, with the entire input as a single chunk.
+    That is one parallel pass (a constant number of kernel launches), rather than
+    a sequential update for each time step.  For very long inputs, call
+    'retention_chunkwise' on smaller chunks instead, to bound memory usage.
+    """
+    if query.size(2) == 0:
+        raise ValueError(
+            f"retention_recurrent_batched requires at least one time step, but got "
+            f"inputs with shape {tuple(query.shape)}"
+        )
+    return retention_chunkwise(
+        query, key, value, prev_state, scale=scale, decay_gammas=decay_gammas
     )
 
+
+def retention_chunkwise(
+    query: Tensor,
+    key: Tensor,
+    value: Tensor,
+    prev_state: Optional[Tensor],
+    scale: Optional[float] = None,
+    decay_gammas: Optional[Tensor] = None,
+) -> Tuple[Tensor, Tensor]:
     # einstein notation:
     # - b: batch_size
     # - h: num_heads
@@ -205,31 +416,41 @@ def retention_chunkwise(
     # - d: head_dim
     if scale is None:
         scale = key.size(-1) ** 0.5
-    key = key / scale
 
-    # intra-chunk (same as parallel retention)
-    similarity = einsum(query, key, "b h n d, b h s d -> b h n s")
-    similarity = similarity * rearrange(decay_mask, "h n s -> () h n s")
-    retention = einsum(similarity, value, "b h n s, b h s d -> b h n d")
+    # intra-chunk (same as parallel retention, so reuse it directly -- including
+    # the fused kernel, when available)
+    # NOTE: Pass 'decay_gammas' through before filling in the defaults, so that
+    # the default case uses the cached decay mask.
+    retention, _ = retention_parallel(
+        query, key, value, scale=scale, decay_gammas=decay_gammas
+    )
+    if decay_gammas is None:
+        decay_gammas = _build_decay_gammas(
+            num_heads=query.shape[1], device=query.device, dtype=query.dtype
+        )
 
+    key = key / scale
     # cross-chunk (derived from recurrent retention)
-    decay_gammas = rearrange(decay_gammas, "h -> () h () ()")
-    inner_pos = rearrange(
-        torch.arange(key.size(2), device=key.device, dtype=key.dtype) + 1,
-        "n -> () () n ()",
-    )
-    state_decays = decay_gammas ** (key.size(2) - inner_pos)
-    discounted_key = einsum(key, state_decays, "b h n d, _ h n _ -> b h n d")
-    state = einsum(discounted_key, value, "b h n d1, b h n d2 -> b h d1 d2")
+    # NOTE: Powers of the decay gammas are computed as 'exp(log_gamma * n)', which
+    # is a cheap pointwise op, compared to a generic 'pow'.
+    #
+    # All of the decays below are powers 'gamma ** j' for 0 <= j <= chunk_length,
+    # so compute them once, and slice out each of the required terms.
+    log_decay_gammas = decay_gammas.log()[:, None, None]
+    chunk_length = key.size(2)
+    powers = torch.arange(chunk_length + 1, device=key.device, dtype=key.dtype)
+    decay_powers = torch.exp(log_decay_gammas * powers[:, None])
+    # gamma ** (chunk_length - j), for j = 1, ..., chunk_length
+    state_decays = decay_powers[:, :chunk_length].flip(dims=(1,))
+    discounted_key = key * state_decays
+    state = torch.matmul(discounted_key.transpose(-2, -1), value)
     if prev_state is not None:
         # Update internal state to return to the user
-        chunk_decay = decay_gammas ** key.size(2)
+        chunk_decay = decay_powers[:, chunk_length:]
         state = state + prev_state * chunk_decay
         # Update the retention Tensor, based on cross-chunk information
-        inner_decay = decay_gammas**inner_pos
-        retention = retention + (
-            einsum(query, prev_state, "b h n d1, b h d1 d2 -> b h n d2") * inner_decay
-        )
+        inner_decay = decay_powers[:, 1:]
+        retention = retention + (torch.matmul(query, prev_state) * inner_decay)
 
     return retention, state
 
@@ -250,6 +471,17 @@ class MultiScaleRetention(nn.Module):
     embeddings to encode positional information ahead of time (if needed at all).
     See: https://github.com/microsoft/torchscale/issues/48
 
+    Setting 'use_sdpa_approx=True' replaces parallel retention with a softmax-based
+    approximation, which uses the fused 'F.scaled_dot_product_attention' kernels.
+    That is *not* equivalent to the recurrent/chunkwise formulations, so only use
+    it when the difference can be tolerated.  See 'retention_sdpa_approx'.
+
+    Setting 'use_cuda_graph=True' replays each 'forward_recurrent' step from a
+    captured CUDA graph, which removes most of the kernel launch overhead during
+    autoregressive decoding.  The graph is only used for CUDA inputs, in eval mode,
+    with gradients disabled, and when 'prev_state' is given.  All other calls run
+    eagerly.  See '_forward_recurrent_graphed'.
+
     Reference:
         "Retentive Network: A Successor to Transformer for Large Language Models"
         https://arxiv.org/pdf/2307.08621v3.pdf
@@ -265,6 +497,8 @@ class MultiScaleRetention(nn.Module):
         batch_first: bool = True,
         activation: Union[ActivationString, Callable[[Tensor], Tensor]] = "swish",
         group_norm_eps: float = 1e-6,
+        use_sdpa_approx: bool = False,
+        use_cuda_graph: bool = False,
         device: Optional[Union[torch.device, str]] = None,
         dtype: Optional[torch.dtype] = None,
         # TODO???
@@ -285,6 +519,8 @@ class MultiScaleRetention(nn.Module):
         self.relative_position = relative_position
         self.bias = bias
         self.activation = activation
+        self.use_sdpa_approx = use_sdpa_approx
+        self.use_cuda_graph = use_cuda_graph
 
         if embed_dim % self.num_heads != 0:
             raise ValueError(
@@ -297,32 +533,24 @@ class MultiScaleRetention(nn.Module):
                 f"head_dim (embed_dim / num_heads = {head_dim}) must be divisible by 8"
             )
 
-        # The q/k/v projection layers are the same as in vanilla MHA.
-        self.q_proj = nn.Parameter(
-            torch.randn(self.num_heads, embed_dim, head_dim, device=device, dtype=dtype)
-            / embed_dim
-        )
-        self.k_proj = nn.Parameter(
-            torch.randn(self.num_heads, embed_dim, head_dim, device=device, dtype=dtype)
-            / embed_dim
-        )
-        self.v_proj = nn.Parameter(
-            torch.randn(self.num_heads, embed_dim, head_dim, device=device, dtype=dtype)
-            / embed_dim
-        )
-        self.group_norm = nn.GroupNorm(
-            num_groups=num_heads,
-            num_channels=embed_dim,
-            affine=False,
-            eps=group_norm_eps,
-            device=device,
-            dtype=dtype,
+        # The q/k/v projection layers are the same as in vanilla MHA.  They are packed
+        # into a single linear layer, so that self-retention (query = key = value)
+        # needs only one large GEMM, rather than three small ones.
+        # NOTE: Any of the linear layers may be replaced by 'Float8Linear' for
+        # inference (see 'to_fp8').
+        self.qkv_proj: Union[nn.Linear, Float8Linear] = nn.Linear(
+            embed_dim, 3 * embed_dim, bias=False, device=device, dtype=dtype
         )
+        # NOTE: Group norm has one group per head, and no affine parameters.  That is
+        # exactly a layer norm over 'head_dim' for each head, which we apply directly
+        # with 'F.layer_norm' (see '_group_norm').  No module is needed, since there
+        # are no parameters or buffers.
+        self.group_norm_eps = group_norm_eps
         # The output project is slightly different, due to the gated "swish" layer.
-        self.g_proj = nn.Linear(
+        self.g_proj: Union[nn.Linear, Float8Linear] = nn.Linear(
             embed_dim, embed_dim, bias=bias, device=device, dtype=dtype
         )
-        self.out_proj = nn.Linear(
+        self.out_proj: Union[nn.Linear, Float8Linear] = nn.Linear(
             embed_dim, embed_dim, bias=bias, device=device, dtype=dtype
         )
 
@@ -334,12 +562,39 @@ class MultiScaleRetention(nn.Module):
             )
         self.thetas: Optional[Tensor]
         self.register_buffer("thetas", thetas)
+        # Decay gammas are constant for each head, so build them once.  As buffers,
+        # they automatically follow the module's device/dtype.  They are
+        # non-persistent, since they can always be re-computed from 'num_heads'.
+        self.decay_gammas: Tensor
+        self.register_buffer(
+            "decay_gammas",
+            # NOTE: Clone, so that in-place updates to the buffer cannot modify
+            # the (shared) cached tensor.  Every forward path reads this buffer,
+            # so in-place updates apply to all of them.
+            _build_decay_gammas(
+                num_heads=num_heads, device=device, dtype=dtype
+            ).clone(),
+            persistent=False,
+        )
+        # Tracks whether 'decay_gammas' still holds the default values, so that the
+        # parallel/chunkwise paths can use the cached decay masks (which are shared
+        # by all layers).  See '_mask_decay_gammas'.
+        self._decay_gammas_version: Optional[Tuple[int, int]] = None
+        self._default_decay_gammas = True
+
+        # CUDA graph for the recurrent step (see '_forward_recurrent_graphed').
+        # Captured lazily, on the first eligible call to 'forward_recurrent'.
+        self._graph: Optional[torch.cuda.CUDAGraph] = None
+        self._graph_key: Optional[Hashable] = None
+        self._graph_inputs: Dict[str, Tensor] = {}
+        self._graph_outputs: Tuple[Tensor, ...] = ()
 
         self._reset_parameters()
 
     def _reset_parameters(self):
         # TODO: Double-check that we're following the same initialization as in
         # the paper.  This is a generic initialization for MHA linear layers.
+        nn.init.normal_(self.qkv_proj.weight, std=1 / self.embed_dim)
         nn.init.xavier_normal_(self.out_proj.weight)
         if self.out_proj.bias is not None:
             nn.init.constant_(self.out_proj.bias, 0)
@@ -347,6 +602,124 @@ class MultiScaleRetention(nn.Module):
         if self.g_proj.bias is not None:
             nn.init.constant_(self.g_proj.bias, 0)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Backwards compatibility: older versions stored separate 'q_proj', 'k_proj',
+        # and 'v_proj' parameters, each with shape (num_heads, embed_dim, head_dim).
+        # Convert them to the packed 'qkv_proj' linear layer.
+        keys = [prefix + name for name in ("q_proj", "k_proj", "v_proj")]
+        if all(key in state_dict for key in keys):
+            weights = [rearrange(state_dict.pop(k), "h e d -> (h d) e") for k in keys]
+            state_dict[prefix + "qkv_proj.weight"] = torch.cat(weights, dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _apply(self, fn, *args, **kwargs):
+        # NOTE: A captured CUDA graph holds the raw addresses of the parameters and
+        # buffers.  Moving or casting the module (e.g. '.to()', '.half()') may
+        # reallocate them, so drop the graph.  It is re-captured on the next call.
+        self._graph = None
+        self._graph_key = None
+        self._graph_inputs = {}
+        self._graph_outputs = ()
+        return super()._apply(fn, *args, **kwargs)
+
+    @torch.no_grad()
+    def to_fp8(self) -> "MultiScaleRetention":
+        """Quantize the q/k/v, gate, and output projections to FP8 (E4M3), with
+        per-tensor scales.  Matmuls then run on FP8 tensor cores, which requires a
+        CUDA device with compute capability >= 8.9 (Ada / Hopper).
+
+        NOTE: This is for inference only.  The quantized layers are not trainable,
+        and this cannot be undone -- keep a copy of the original weights if needed.
+        """
+        device = self.qkv_proj.weight.device
+        if not fp8_available(device):
+            raise RuntimeError(
+                "FP8 projections require a CUDA device with compute capability >= "
+                f"{MIN_FP8_CAPABILITY}, and PyTorch with FP8 support (device={device})"
+            )
+
+        if isinstance(self.qkv_proj, nn.Linear):
+            self.qkv_proj = Float8Linear(self.qkv_proj)
+        if isinstance(self.g_proj, nn.Linear):
+            self.g_proj = Float8Linear(self.g_proj)
+        if isinstance(self.out_proj, nn.Linear):
+            self.out_proj = Float8Linear(self.out_proj)
+        # Any captured CUDA graph still references the old projection weights.
+        self._graph = None
+        self._graph_key = None
+        self._graph_inputs = {}
+        self._graph_outputs = ()
+        return self
+
+    def _mask_decay_gammas(self) -> Optional[Tensor]:
+        # Decay gammas for building decay masks.  Returns None while the buffer still
+        # holds the default values, so that callers use the cached default masks.
+        # Otherwise (e.g. after an in-place update, or for learnable gammas) returns
+        # the buffer itself.  Equality is only re-checked when the buffer changes,
+        # so this does not synchronize with the device on every call.
+        gammas = self.decay_gammas
+        if gammas.requires_grad:
+            return gammas
+        version = (gammas.data_ptr(), gammas._version)
+        if version != self._decay_gammas_version:
+            default = _build_decay_gammas(
+                num_heads=self.num_heads, device=gammas.device, dtype=gammas.dtype
+            )
+            self._default_decay_gammas = torch.equal(gammas, default)
+            self._decay_gammas_version = version
+        return None if self._default_decay_gammas else gammas
+
+    def _group_norm(self, retention: Tensor) -> Tensor:
+        # Normalize each head independently, over the last (head_dim) axis.  This is
+        # applied at each sequence position separately, which is equivalent to the
+        # recurrent formulation (rather than normalizing over the entire sequence).
+        return F.layer_norm(retention, retention.shape[-1:], eps=self.group_norm_eps)
+
+    def _gated_output(self, retention: Tensor, query: Tensor) -> Tensor:
+        gate = self.g_proj(query)
+        if self.activation is F.silu:
+            retention = _swish_gate(retention, gate)
+        else:
+            retention = retention * self.activation(gate)
+        return self.out_proj(retention)
+
+    def _split_heads(self, x: Tensor) -> Tensor:
+        # (b, n, h * d) -> (b, h, n, d), or (b, h * d) -> (b, h, d) for a single time
+        # step.  Uses reshape/transpose directly, rather than 'rearrange', since
+        # this is called several times in every forward pass.
+        x = x.reshape(*x.shape[:-1], self.num_heads, -1)
+        return x.transpose(1, 2) if x.dim() == 4 else x
+
+    def _merge_heads(self, x: Tensor) -> Tensor:
+        # Inverse of '_split_heads'.  Folds heads back into the embedding dimension.
+        if x.dim() == 4:
+            x = x.transpose(1, 2)
+        return x.flatten(start_dim=-2)
+
+    def _qkv_projection(
+        self, query: Tensor, key: Tensor, value: Tensor
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        # NOTE: The authors use retention in a decoder-only model, where the q/k/v
+        # inputs are the same (i.e. X = q = k = v).  Detect that case (by identity,
+        # which is free), and avoid projecting the same input multiple times.
+        if query is key and key is value:
+            # Self-retention: a single packed GEMM for all three projections.
+            q, k, v = self.qkv_proj(query).chunk(3, dim=-1)
+            return q, k, v
+
+        q_weight, kv_weight = self.qkv_proj.weight.split(
+            [self.embed_dim, 2 * self.embed_dim], dim=0
+        )
+        q = F.linear(query, q_weight)
+        if key is value:
+            # Shared key/value input: one packed GEMM for both projections.
+            k, v = F.linear(key, kv_weight).chunk(2, dim=-1)
+        else:
+            k_weight, v_weight = kv_weight.chunk(2, dim=0)
+            k = F.linear(key, k_weight)
+            v = F.linear(value, v_weight)
+        return q, k, v
+
     def forward_parallel(
         self,
         query: Tensor,
@@ -361,28 +734,15 @@ class MultiScaleRetention(nn.Module):
         # d - embedding dimension
         #
         # Input shape: (b, n, d)
-        q = einsum(
-            query,
-            self.q_proj,
-            "b sqlen embed, numheads embed headdim -> b numheads sqlen headdim",
-        )
-        k = einsum(
-            key,
-            self.k_proj,
-            "b sqlen embed, numheads embed headdim -> b numheads sqlen headdim",
-        )
-        v = einsum(
-            value,
-            self.v_proj,
-            "b sqlen embed,numheads embed headdim -> b numheads sqlen headdim",
-        )
+        q, k, v = self._qkv_projection(query, key, value)
+        q = self._split_heads(q)
+        k = self._split_heads(k)
+        v = self._split_heads(v)
 
         if self.relative_position:
             assert self.thetas is not None
             indices = torch.arange(q.size(2), device=q.device, dtype=q.dtype)
-            indices = rearrange(indices, "n -> () () n ()")
-            thetas = rearrange(self.thetas, "d -> () () () d")
-            angles = indices * thetas
+            angles = indices[:, None] * self.thetas
             sin = torch.sin(angles)
             cos = torch.cos(angles)
 
@@ -390,16 +750,25 @@ class MultiScaleRetention(nn.Module):
             k = _theta_shift(k, sin, cos)
 
         # Apply retention then group norm.
-        retention, weights = retention_parallel(q, k, v, need_weights=need_weights)
-        # To apply group norm in an equivalent way to the recurrent formulation,
-        # we fold the sequence dimension into the batch dimension.  Otherwise,
-        # normalization would be applied over the entire input sequence.
-        batch_size = retention.size(0)
-        retention = rearrange(retention, "b h n d -> (b n) (h d)")
-        retention = F.dropout(retention, p=self.dropout, training=self.training)
-        retention = self.group_norm(retention)
-        # Unfold 'n' from the batch dimension, and fold 'h' back into the embed dim.
-        retention = rearrange(retention, "(b n) e -> b n e", b=batch_size)
+        weights: Optional[Tensor] = None
+        if self.use_sdpa_approx and not need_weights:
+            # NOTE: Approximation only -- see 'retention_sdpa_approx'.
+            retention = retention_sdpa_approx(
+                q, k, v, decay_gammas=self._mask_decay_gammas()
+            )
+        else:
+            retention, weights = retention_parallel(
+                q,
+                k,
+                v,
+                need_weights=need_weights,
+                decay_gammas=self._mask_decay_gammas(),
+            )
+        if self.dropout > 0 and self.training:
+            retention = F.dropout(retention, p=self.dropout)
+        retention = self._group_norm(retention)
+        # Fold heads back into the embedding dimension.
+        retention = self._merge_heads(retention)
 
         # NOTE: Unlike multihead attention, the retention paper applies a "swish"
         # gate to increase the non-linear capacity of the model.  (IMO this is likely
@@ -410,8 +779,7 @@ class MultiScaleRetention(nn.Module):
         # where X is the input to the layer.  The authors use Retention in a
         # Decoder-only model, the q/k/v inputs are the same (i.e. X = q = k = v).
         # So, I assume that 'query' can equivalently be used as the input.
-        gate = self.activation(self.g_proj(query))
-        retention = self.out_proj(retention * gate)
+        retention = self._gated_output(retention, query)
 
         return retention, weights
 
@@ -422,6 +790,31 @@ class MultiScaleRetention(nn.Module):
         value: Tensor,
         seq_idx: int,
         prev_state: Optional[Tensor],
+    ) -> Tuple[Tensor, Tensor]:
+        angles: Optional[Tensor] = None
+        if self.relative_position:
+            assert self.thetas is not None
+            angles = seq_idx * self.thetas
+
+        if (
+            self.use_cuda_graph
+            and prev_state is not None
+            and query.is_cuda
+            and not self.training
+            and not torch.is_grad_enabled()
+        ):
+            return self._forward_recurrent_graphed(
+                query, key, value, angles, prev_state
+            )
+        return self._forward_recurrent(query, key, value, angles, prev_state)
+
+    def _forward_recurrent(
+        self,
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        angles: Optional[Tensor],
+        prev_state: Optional[Tensor],
     ) -> Tuple[Tensor, Tensor]:
         # einstein notation:
         # b - batch size
@@ -429,20 +822,12 @@ class MultiScaleRetention(nn.Module):
         # d - embedding dimension
         #
         # input shape: (b, d)
-        q = einsum(
-            query, self.q_proj, "b embed, numheads embed headdim -> b numheads headdim"
-        )
-        k = einsum(
-            key, self.k_proj, "b embed, numheads embed headdim -> b numheads headdim"
-        )
-        v = einsum(
-            value, self.v_proj, "b embed,numheads embed headdim -> b numheads headdim"
-        )
+        q, k, v = self._qkv_projection(query, key, value)
+        q = self._split_heads(q)
+        k = self._split_heads(k)
+        v = self._split_heads(v)
 
-        if self.relative_position:
-            assert self.thetas is not None
-            thetas = rearrange(self.thetas, "d -> () () d")
-            angles = seq_idx * thetas
+        if angles is not None:
             sin = torch.sin(angles)
             cos = torch.cos(angles)
 
@@ -450,11 +835,14 @@ class MultiScaleRetention(nn.Module):
             k = _theta_shift(k, sin, cos)
 
         # Apply retention then group norm.
-        retention, state = retention_recurrent(q, k, v, prev_state=prev_state)
-        retention = F.dropout(retention, p=self.dropout, training=self.training)
+        retention, state = retention_recurrent(
+            q, k, v, prev_state=prev_state, decay_gammas=self.decay_gammas
+        )
+        if self.dropout > 0 and self.training:
+            retention = F.dropout(retention, p=self.dropout)
+        retention = self._group_norm(retention)
         # Fold heads back into the embedding dimension.
-        retention = rearrange(retention, "b h d -> b (h d)")
-        retention = self.group_norm(retention)
+        retention = self._merge_heads(retention)
 
         # NOTE: Unlike multihead attention, the retention paper applies a "swish"
         # gate to increase the non-linear capacity of the model.  (IMO this is likely
@@ -465,11 +853,124 @@ class MultiScaleRetention(nn.Module):
         # where X is the input to the layer.  The authors use Retention in a
         # Decoder-only model, the q/k/v inputs are the same (i.e. X = q = k = v).
         # So, I assume that 'query' can equivalently be used as the input.
-        gate = self.activation(self.g_proj(query))
-        retention = self.out_proj(retention * gate)
+        retention = self._gated_output(retention, query)
 
         return retention, state
 
+    def _forward_recurrent_graphed(
+        self,
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        angles: Optional[Tensor],
+        prev_state: Tensor,
+    ) -> Tuple[Tensor, Tensor]:  # pragma: no cover
+        """Recurrent step, replayed from a captured CUDA graph.  Autoregressive
+        decoding calls 'forward_recurrent' once per token, and each call launches
+        many tiny kernels -- so launch overhead dominates the actual compute.  A
+        graph replays all of them with a single launch.
+
+        The graph is captured on the first call, and re-captured whenever the input
+        shapes, dtype, or device change, or the module itself is moved or cast.
+
+        NOTE: CUDA graphs require a GPU, so this (and '_capture_recurrent_graph') is
+        excluded from CPU coverage.  See 'test_multiscale_retention_cuda_graph'.
+        """
+        self_retention = query is key and key is value
+        graph_key = (
+            query.shape,
+            key.shape,
+            prev_state.shape,
+            query.dtype,
+            query.device,
+            self_retention,
+            angles is None,
+        )
+        if self._graph is None or self._graph_key != graph_key:
+            self._capture_recurrent_graph(query, key, value, angles, prev_state)
+            self._graph_key = graph_key
+
+        inputs = self._graph_inputs
+        inputs["query"].copy_(query)
+        if not self_retention:
+            inputs["key"].copy_(key)
+            inputs["value"].copy_(value)
+        if angles is not None:
+            inputs["angles"].copy_(angles)
+        inputs["prev_state"].copy_(prev_state)
+
+        assert self._graph is not None
+        self._graph.replay()
+        # NOTE: Outputs are static buffers, which are overwritten by the next replay.
+        # Clone them, so that callers can safely hold onto the returned tensors.
+        retention, state = self._graph_outputs
+        return retention.clone(), state.clone()
+
+    def _capture_recurrent_graph(
+        self,
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        angles: Optional[Tensor],
+        prev_state: Tensor,
+    ):  # pragma: no cover
+        # Static input buffers.  For self-retention, preserve the identity of the
+        # q/k/v inputs, so that the captured graph uses the packed projection.
+        inputs = {"query": query.clone(), "prev_state": prev_state.clone()}
+        if query is key and key is value:
+            inputs["key"] = inputs["value"] = inputs["query"]
+        else:
+            inputs["key"] = key.clone()
+            inputs["value"] = value.clone()
+        if angles is not None:
+            inputs["angles"] = angles.clone()
+
+        def step() -> Tuple[Tensor, Tensor]:
+            return self._forward_recurrent(
+                inputs["query"],
+                inputs["key"],
+                inputs["value"],
+                inputs.get("angles"),
+                inputs["prev_state"],
+            )
+
+        # Warm up on a side stream before capturing, as recommended by PyTorch.
+        # (This also triggers any lazy initialization, e.g. JIT-scripted functions.)
+        stream = torch.cuda.Stream(device=query.device)
+        stream.wait_stream(torch.cuda.current_stream(query.device))
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                step()
+        torch.cuda.current_stream(query.device).wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            outputs = step()
+
+        self._graph = graph
+        self._graph_inputs = inputs
+        self._graph_outputs = outputs
+
+    def forward_recurrent_batched(
+        self,
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        start_idx: int,
+        prev_state: Optional[Tensor],
+    ) -> Tuple[Tensor, Tensor]:
+        """Equivalent to calling 'forward_recurrent' for each time step, e.g. to
+        prefill the state before autoregressive decoding.  This is exactly
+        'forward_chunkwise', with the entire input as a single chunk -- see
+        'retention_recurrent_batched'.
+        """
+        if query.size(1) == 0:
+            raise ValueError(
+                f"forward_recurrent_batched requires at least one time step, but got "
+                f"inputs with shape {tuple(query.shape)}"
+            )
+        return self.forward_chunkwise(query, key, value, start_idx, prev_state)
+
     def forward_chunkwise(
         self,
         query: Tensor,
@@ -485,21 +986,10 @@ class MultiScaleRetention(nn.Module):
         # d - embedding dimension
         #
         # Input shape: (b, n, d)
-        q = einsum(
-            query,
-            self.q_proj,
-            "b sqlen embed, numheads embed headdim -> b numheads sqlen headdim",
-        )
-        k = einsum(
-            key,
-            self.k_proj,
-            "b sqlen embed, numheads embed headdim -> b numheads sqlen headdim",
-        )
-        v = einsum(
-            value,
-            self.v_proj,
-            "b sqlen embed,numheads embed headdim -> b numheads sqlen headdim",
-        )
+        q, k, v = self._qkv_projection(query, key, value)
+        q = self._split_heads(q)
+        k = self._split_heads(k)
+        v = self._split_heads(v)
 
         if self.relative_position:
             # global (cross-chunk) + intra-chunk relative position embedding
@@ -507,25 +997,21 @@ class MultiScaleRetention(nn.Module):
             indices = torch.arange(
                 start_idx, start_idx + q.size(2), device=q.device, dtype=q.dtype
             )
-            indices = rearrange(indices, "n -> () () n ()")
-            thetas = rearrange(self.thetas, "d -> () () () d")
-            angles = indices * thetas
+            angles = indices[:, None] * self.thetas
             sin = torch.sin(angles)
             cos = torch.cos(angles)
             q = _theta_shift(q, sin, cos)
             k = _theta_shift(k, sin, cos)
 
         # Apply retention then group norm.
-        retention, state = retention_chunkwise(q, k, v, prev_state=prev_state)
-        # To apply group norm in an equivalent way to the recurrent formulation,
-        # we fold the sequence dimension into the batch dimension.  Otherwise,
-        # normalization would be applied over the entire input sequence.
-        batch_size = retention.size(0)
-        retention = rearrange(retention, "b h n d -> (b n) (h d)")
-        retention = F.dropout(retention, p=self.dropout, training=self.training)
-        retention = self.group_norm(retention)
-        # Unfold 'n' from the batch dimension, and fold 'h' back into the embed dim.
-        retention = rearrange(retention, "(b n) e -> b n e", b=batch_size)
+        retention, state = retention_chunkwise(
+            q, k, v, prev_state=prev_state, decay_gammas=self._mask_decay_gammas()
+        )
+        if self.dropout > 0 and self.training:
+            retention = F.dropout(retention, p=self.dropout)
+        retention = self._group_norm(retention)
+        # Fold heads back into the embedding dimension.
+        retention = self._merge_heads(retention)
 
         # NOTE: Unlike multihead attention, the retention paper applies a "swish"
         # gate to increase the non-linear capacity of the model.  (IMO this is likely
@@ -536,8 +1022,7 @@ class MultiScaleRetention(nn.Module):
         # where X is the input to the layer.  The authors use Retention in a
         # Decoder-only model, the q/k/v inputs are the same (i.e. X = q = k = v).
         # So, I assume that 'query' can equivalently be used as the input.
-        gate = self.activation(self.g_proj(query))
-        retention = self.out_proj(retention * gate)
+        retention = self._gated_output(retention, query)
 
         return retention, state
 
@@ -553,24 +1038,37 @@ class MultiScaleRetention(nn.Module):
 
 if __name__ == "__main__":
     batch_size = 1
-    seq_len = 3
+    seq_len = 8
+    chunk_size = 4
     embed_dim = 16
     num_heads = 2
 
     layer = MultiScaleRetention(
         embed_dim=embed_dim,
         num_heads=num_heads,
-    )
-
+    ).eval()
     x = torch.randn(batch_size, seq_len, embed_dim)
-    y_chunkwise, chunkwise_state = retention_chunkwise(x, x, x, prev_state=None)
-    print(chunkwise_state)
-    print("-" * 40)
-
-    y_recurrent = torch.zeros_like(y_chunkwise)
-    recurrent_state = None
-    for i in range(seq_len):
-        y_recurrent[:, :, i, :], recurrent_state = retention_recurrent(
-            x[:, :, i, :], x[:, :, i, :], x[:, :, i, :], prev_state=recurrent_state
-        )
-    print(recurrent_state)
+
+    with torch.no_grad():
+        y_chunkwise = torch.zeros_like(x)
+        chunkwise_state = None
+        for i in range(0, seq_len, chunk_size):
+            xc = x[:, i : i + chunk_size]
+            y_chunkwise[:, i : i + chunk_size], chunkwise_state = (
+                layer.forward_chunkwise(
+                    xc, xc, xc, start_idx=i, prev_state=chunkwise_state
+                )
+            )
+        print(chunkwise_state)
+        print("-" * 40)
+
+        y_recurrent = torch.zeros_like(x)
+        recurrent_state = None
+        for i in range(seq_len):
+            xr = x[:, i]
+            y_recurrent[:, i], recurrent_state = layer.forward_recurrent(
+                xr, xr, xr, seq_idx=i, prev_state=recurrent_state
+            )
+        print(recurrent_state)
+
+    torch.testing.assert_close(y_chunkwise, y_recurrent)